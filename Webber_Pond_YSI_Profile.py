@@ -5,24 +5,31 @@ import numpy as np  # For numerical computations
 # Dash for interactive web applications
 import dash  # To create web applications with Python
 from dash import dcc, html  # Core components and HTML for Dash apps
-from dash.dependencies import Input, Output  # Links components with callback functions
+from dash.dependencies import Input, Output, State, ClientsideFunction  # Links components with callback functions
 
 # Plotly for data visualizations
 import plotly.express as px  # For creating interactive plots with Plotly Express
 import plotly.graph_objs as go  # For more detailed control over Plotly figures
 
+# Columnar file storage
+import pyarrow.parquet as pq  # To read Parquet schemas without loading the data
+
 # Geospatial calculations
-from geopy.distance import geodesic  # To calculate distances between coordinates
+from scipy.spatial import cKDTree  # KD-tree for fast radius queries between coordinates
+from scipy.sparse import coo_matrix  # Sparse adjacency between nearby points
+from scipy.sparse.csgraph import connected_components  # Groups points linked by nearby pairs
 
 # Data export and input/output
 import os  # For file and directory operations
 import re  # For pattern matching in strings
+import functools  # For binding read options to the CSV reader
+from concurrent.futures import ThreadPoolExecutor  # For reading raw CSV files in parallel
 
 # Define directory paths within the current working directory (assumed to be "Webber_Pond_YSI_Profile")
 base_dir = os.getcwd()  # This will be the "Webber_Pond_YSI_Profile" directory
 
 raw_dir = os.path.join(base_dir, "Webber Pond", "Raw")  # Raw .csv files should be stored here
-input_dir = os.path.join(raw_dir, "YSI Geo Split")  # Where to read the geo grouped files
+input_dir = os.path.join(raw_dir, "YSI Geo Split")  # Where to read the geo grouped .parquet files
 output_dir = os.path.join(base_dir, "Webber Pond", "Output")  # Master directory of compiled files
 plots_dir = os.path.join(output_dir, "Plots")  # Directory specifically for profile plots
 geo_dir = os.path.join(output_dir, "Geo") # ****Unused**** intended for KML or other GIS Outputs
@@ -46,19 +53,28 @@ for directory in directories:
 # Define the distance threshold
 distance_threshold_m = 50
 
-# Initialize an empty DataFrame to hold all data
-master_df = pd.DataFrame()
+# Collect the paths of all CSV files in raw_dir
+with os.scandir(raw_dir) as entries:
+    raw_paths = [entry.path for entry in entries if entry.is_file() and entry.name.endswith('.csv')]
 
 # Counter for the number of files loaded
-file_count = 0
+file_count = len(raw_paths)
+
+# Read the files in parallel (the C parser releases the GIL while parsing)
+read_raw_csv = functools.partial(pd.read_csv, encoding='ISO-8859-1', on_bad_lines='skip', engine='c',
+                                 dtype={'Lat': 'float64', 'Lon': 'float64'})
+with ThreadPoolExecutor() as executor:
+    frames = list(executor.map(read_raw_csv, raw_paths))
 
-# Loop through all CSV files in raw_dir and append their contents to master_df
-for file_name in os.listdir(raw_dir):
-    if file_name.endswith('.csv'):
-        file_path = os.path.join(raw_dir, file_name)
-        df = pd.read_csv(file_path, encoding='ISO-8859-1', on_bad_lines='skip')
-        master_df = pd.concat([master_df, df], ignore_index=True)
-        file_count += 1
+# Combine all files into master_df with a single concat
+master_df = pd.concat(frames, ignore_index=True)
+
+# Downcast sensor readings to float32 and text columns to categories to halve memory use
+# (Lat and Lon keep full precision for the distance grouping and file names)
+for col in master_df.select_dtypes(include='float64').columns.difference(['Lat', 'Lon']):
+    master_df[col] = pd.to_numeric(master_df[col], downcast='float')
+for col in master_df.select_dtypes(include=['object', 'string']).columns:
+    master_df[col] = master_df[col].astype('category')
 
 # Print the count of loaded files and preview the first 5 rows of the master DataFrame
 print(f"Loaded {file_count} files")
@@ -66,9 +82,21 @@ print(master_df.head(5))
 
 mapbox_token = os.getenv("MAPBOX_TOKEN", "default_token_if_missing")
 
-# Function to calculate distance between two latitude/longitude points in meters
-def distance_in_meters(lat1, lon1, lat2, lon2):
-    return geodesic((lat1, lon1), (lat2, lon2)).meters
+# Mean Earth radius in meters, used to project lat/lon onto a local plane
+earth_radius_m = 6371000
+
+# Function to calculate haversine distances (meters) from one point to arrays of points, all in radians
+def haversine_m(lat1, lon1, lat_arr, lon_arr):
+    dlat = lat_arr - lat1
+    dlon = lon_arr - lon1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat_arr) * np.sin(dlon / 2) ** 2
+    return 2 * earth_radius_m * np.arcsin(np.sqrt(a))
+
+# Function to project Lat/Lon (degrees) to x/y meters, equirectangular around a reference latitude
+def project_to_meters(lat, lon, lat_ref):
+    x = np.radians(lon) * earth_radius_m * np.cos(np.radians(lat_ref))
+    y = np.radians(lat) * earth_radius_m
+    return x, y
 
 # Initialize an empty list to hold the grouped DataFrames
 geo_grouped_dfs = []
@@ -79,37 +107,62 @@ file_count = 0
 # Drop any rows with NaN values in Lat or Lon columns from master_df (assumed to be previously loaded)
 df_cleaned = master_df.dropna(subset=['Lat', 'Lon'])
 
-while not df_cleaned.empty:
-    # Take the first point
-    first_point = df_cleaned.iloc[0]
-    lat1, lon1 = first_point['Lat'], first_point['Lon']
-    
-    # Find all points within distance_threshold_m meters of the first point
-    mask = df_cleaned.apply(lambda row: distance_in_meters(lat1, lon1, row['Lat'], row['Lon']) <= distance_threshold_m, axis=1)
-    group = df_cleaned[mask]
-    
-    # Append the group to the list of grouped DataFrames
-    geo_grouped_dfs.append(group)
+# Remove empty columns (columns with all NaN values) once, rather than from every group
+non_empty_cols = df_cleaned.columns[df_cleaned.notna().any()].tolist()
+df_cleaned = df_cleaned[non_empty_cols]
+
+# Collapse repeated coordinates (a profile cast logs many rows at the same point) so the pairs below
+# grow with the number of distinct points, not the number of rows
+unique_coords, coord_index = np.unique(np.column_stack([df_cleaned['Lat'].values, df_cleaned['Lon'].values]),
+                                       axis=0, return_inverse=True)
+coord_index = coord_index.ravel()
+
+# Convert Lat/Lon to radians once for the distance calculations
+lat_rad = np.radians(unique_coords[:, 0])
+lon_rad = np.radians(unique_coords[:, 1])
+
+# Project Lat/Lon to meters (equirectangular around the mean latitude) and build a KD-tree once
+lat0 = df_cleaned['Lat'].mean()
+x, y = project_to_meters(unique_coords[:, 0], unique_coords[:, 1], lat0)
+tree = cKDTree(np.column_stack([x, y]))
+
+# Find all candidate pairs of nearby points in one tree query (small margin for projection error)
+pairs = tree.query_pairs(r=distance_threshold_m * 1.01, output_type='ndarray')
+
+# Keep the pairs within distance_threshold_m meters by haversine distance
+mask = haversine_m(lat_rad[pairs[:, 0]], lon_rad[pairs[:, 0]], lat_rad[pairs[:, 1]], lon_rad[pairs[:, 1]]) <= distance_threshold_m
+pairs = pairs[mask]
+
+# Group points connected through chains of nearby pairs (independent of the point order),
+# then map the labels of the distinct points back to every row
+adjacency = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(unique_coords), len(unique_coords)))
+_, point_labels = connected_components(adjacency, directed=False)
+group_labels = point_labels[coord_index]
+
+# Names of the split files written by this run
+written_files = set()
+
+for _, group in df_cleaned.groupby(group_labels, sort=True):
+    # Determine the centroid Lat and Lon (rounded) to name the file
+    centroid_lat = round(group['Lat'].mean(), 5)
+    centroid_lon = round(group['Lon'].mean(), 5)
     
-    # Drop the grouped points from the original DataFrame
-    df_cleaned = df_cleaned[~mask]
-    
-    # Determine mode for Lat and Lon to name the file
-    mode_lat = np.round(group['Lat'].mode()[0], 5)
-    mode_lon = np.round(group['Lon'].mode()[0], 5)
-    
-    # Define the output file name with mode Lat and Lon values
-    filename = f"{mode_lat}Lat_{mode_lon}Lon.csv"
+    # Define the output file name with centroid Lat and Lon values
+    filename = f"{centroid_lat}Lat_{centroid_lon}Lon.parquet"
     output_path = os.path.join(input_dir, filename)
     
     # Drop the 'Lat' and 'Lon' columns from the group DataFrame
-    group.drop(columns=['Lat', 'Lon'], inplace=True)
-    
-    # Remove empty columns (columns with all NaN values)
-    group.dropna(axis=1, how='all', inplace=True)
-    
-    # Save the group as a CSV file without Lat, Lon, and empty columns
-    group.to_csv(output_path, index=False)
+    group = group.drop(columns=['Lat', 'Lon'])
+
+    # Append the group to the list of grouped DataFrames
+    geo_grouped_dfs.append(group)
+
+    # Save the group as a Parquet file without Lat, Lon, and the columns empty across the whole survey
+    # (written to a temporary file first and swapped in, so other workers never read a partial file)
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    group.to_parquet(temp_path, engine='pyarrow', compression='zstd', index=False)
+    os.replace(temp_path, output_path)
+    written_files.add(filename)
     
     # Increment the file counter
     file_count += 1
@@ -117,6 +170,16 @@ while not df_cleaned.empty:
 # Print the total count of files created
 print(f"{file_count} files created in {input_dir}")
 
+# Remove split files left by a previous run whose names were not written this time, so no site is
+# loaded twice (done after writing, so the directory never lacks the current split)
+with os.scandir(input_dir) as entries:
+    for entry in entries:
+        if entry.is_file() and entry.name.endswith('.parquet') and entry.name not in written_files:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Already removed by another worker
+
 # Initialize the Dash app
 app = dash.Dash(__name__)
 server = app.server  # Expose the underlying Flask server if needed by Render
@@ -126,7 +189,7 @@ app.title = "Water Quality Map with Profile Plots"
 parameters = ["Chl ug/L", "PC ug/L", "°C", "DO mg/L", "pH", "ORP mV"]
 
 # Regular expression pattern to extract latitude and longitude from filename
-filename_pattern = re.compile(r"(?P<lat>-?\d+\.\d+)Lat_(?P<lon>-?\d+\.\d+)Lon\.csv")
+filename_pattern = re.compile(r"(?P<lat>-?\d+\.\d+)Lat_(?P<lon>-?\d+\.\d+)Lon\.parquet")
 
 # Verify the content of each grouped DataFrame after file creation
 for i, df in enumerate(geo_grouped_dfs, start=1):
@@ -135,56 +198,120 @@ for i, df in enumerate(geo_grouped_dfs, start=1):
 
 # Existing code to load and process files into site_data
 site_data = []
-for file_name in os.listdir(input_dir):
-    if file_name.endswith('.csv'):
-        match = filename_pattern.match(file_name)
-        if match:
-            lat = float(match.group("lat"))
-            lon = float(match.group("lon"))
-            file_path = os.path.join(input_dir, file_name)
-            df = pd.read_csv(file_path)
-
-            # Display the first few rows of each DataFrame as it is loaded
-            print(f"\nLoading data for {file_name}:")
-            print(df.head())
-
-            # Store data for each site in a list with latitude, longitude, and file path
-            site_data.append({"Latitude": lat, "Longitude": lon, "FilePath": file_path})
-
-
-# Add sequential labels to each site
-for i, site in enumerate(site_data, start=1):
+site_frames = []  # Parsed DataFrame of each site, in the same order as site_data
+with os.scandir(input_dir) as entries:
+    site_entries = sorted((entry for entry in entries if entry.is_file() and entry.name.endswith('.parquet')),
+                          key=lambda entry: entry.name)
+for entry in site_entries:
+    match = filename_pattern.match(entry.name)
+    if match:
+        lat = float(match.group("lat"))
+        lon = float(match.group("lon"))
+        file_path = entry.path
+
+        # Read only the depth and parameter columns present in the file
+        # (skip stale files another worker removed after this directory was listed)
+        try:
+            available_cols = pq.read_schema(file_path).names
+            df = pd.read_parquet(file_path, columns=[col for col in ['DEP m'] + parameters if col in available_cols])
+        except FileNotFoundError:
+            continue
+
+        # Display the first few rows of each DataFrame as it is loaded
+        print(f"\nLoading data for {entry.name}:")
+        print(df.head())
+
+        # Store data for each site in a list with latitude, longitude, and file path
+        site_data.append({"Latitude": lat, "Longitude": lon, "FilePath": file_path})
+        site_frames.append(df)
+
+
+# Function to average columns at each depth: sort by depth once, then sum each run of equal depths
+# with np.add.reduceat in float64 (NaN values are skipped, as in a pandas groupby mean)
+def depth_means(df, cols):
+    dep = df['DEP m'].to_numpy(dtype=np.float64)
+    keep = ~np.isnan(dep)
+    order = np.argsort(dep[keep], kind='stable')
+    depths, starts = np.unique(dep[keep][order], return_index=True)
+    if len(depths) == 0:
+        return pd.DataFrame(columns=cols, index=pd.Index([], name='DEP m'), dtype=float)
+
+    means = {}
+    for col in cols:
+        vals = df[col].to_numpy(dtype=np.float64)[keep][order]
+        valid = ~np.isnan(vals)
+        sums = np.add.reduceat(np.where(valid, vals, 0), starts)
+        counts = np.add.reduceat(valid.astype(np.int64), starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[col] = sums / counts
+    return pd.DataFrame(means, index=pd.Index(depths, name='DEP m'))
+
+# Add sequential labels to each site and precompute its depth profile
+site_profiles = {}  # Depth-averaged parameters of each site (indexed by 'DEP m'), keyed by label
+for i, (site, df) in enumerate(zip(site_data, site_frames), start=1):
     site["Sample Site"] = f"Sample Site {i}"
 
+    # Average every available parameter at each depth in a single sorted pass
+    if 'DEP m' in df.columns:
+        agg_cols = [param for param in parameters if param in df.columns]
+        site_profiles[site["Sample Site"]] = depth_means(df, agg_cols)
+    else:
+        site_profiles[site["Sample Site"]] = pd.DataFrame()
+
 # Load the data for "Sample Site 1" as default
 default_site = site_data[0]  # Sample Site 1
 
-# Function to create a scatter plot for a site and parameter with averaged values by depth
-def generate_profile_plot(df, parameter):
-    if parameter not in df.columns or 'DEP m' not in df.columns:
-        print(f"Parameter '{parameter}' or 'DEP m' not found in DataFrame columns: {df.columns}")
-        return go.Figure()
-
-    # Group by 'DEP m' and calculate the mean of the selected parameter at each depth
-    averaged_df = df.groupby('DEP m')[parameter].mean().reset_index()
-
-    # Create a scatter plot
-    fig = px.scatter(
-        averaged_df,
-        x=parameter,
-        y="DEP m",
-        title=f"{parameter} Profile",
-        labels={parameter: parameter, "DEP m": "Depth (m)"}
-    )
-    
-    fig.update_yaxes(autorange="reversed")  # Invert y-axis for depth
-    
-    return fig
+# Build the profile plot once as an empty scatter; the browser only fills in its data and titles
+profile_fig = go.Figure(go.Scatter(x=[], y=[], mode="markers", hovertemplate="%{x}<br>Depth (m)=%{y}<extra></extra>"))
+profile_fig.update_layout(title_text="Profile", yaxis_title_text="Depth (m)")
+profile_fig.update_yaxes(autorange="reversed")  # Invert y-axis for depth
+
+# Function to convert a depth profile to lists of plain floats for the browser, rounded to 4 decimals
+# (finer than the sensor resolution) so the float32 readings do not carry rounding noise into the plot
+# (e.g. 137.4 instead of 137.39999389648438)
+def profile_to_lists(profile):
+    return profile.reset_index().round(4).to_dict('list')
+
+# Depth profiles of every site, sent to the browser once with the layout
+# (with the profile plot's template, so figures built in the browser keep the same styling)
+all_profiles = {
+    "default": default_site["Sample Site"],
+    "template": profile_fig.layout.template.to_plotly_json(),
+    "profiles": {label: profile_to_lists(profile) for label, profile in site_profiles.items()}
+}
+
+# Build the map figure once; the sites do not change while the app is running
+# (only the columns the map uses are copied out of site_data)
+map_df = pd.DataFrame(site_data, columns=["Latitude", "Longitude", "Sample Site"])
+
+# Create the map figure
+map_fig = px.scatter_mapbox(
+    map_df,
+    lat="Latitude",
+    lon="Longitude",
+    hover_name="Sample Site",
+    title="Sample Site Locations",
+    zoom=12  # Set zoom level closer
+)
+map_fig.update_traces(marker=dict(size=10, color="blue", opacity=0.8))
+
+# Attach each site's label to its marker so clicks can be matched without comparing coordinates
+map_fig.update_traces(customdata=map_df["Sample Site"])
+
+# Mapbox settings
+map_fig.update_layout(
+    mapbox_style="satellite",
+    mapbox_accesstoken=mapbox_token,
+    margin={"r": 0, "t": 0, "l": 0, "b": 0}
+)
 
 # Create the layout of the Dash app
 app.layout = html.Div([
     html.H1("Water Quality Map with Sample Site Profiles"),
 
+    # Depth profiles of all sites, used by the profile plot without calling the server
+    dcc.Store(id="all-profiles", data=all_profiles),
+
     # Dropdown for parameter selection
     html.Div([
         html.Label("Select Parameter for Profile Plot:"),
@@ -199,70 +326,23 @@ app.layout = html.Div([
     html.Div(
         children=[
             # Map on the left
-            dcc.Graph(id="map", style={'width': '55%', 'display': 'inline-block', 'height': '75vh'}),
+            dcc.Graph(id="map", figure=map_fig, style={'width': '55%', 'display': 'inline-block', 'height': '75vh'}),
             
             # Profile plot on the right
-            dcc.Graph(id="profile-plot", style={'width': '40%', 'display': 'inline-block', 'height': '75vh'})
+            dcc.Graph(id="profile-plot", figure=profile_fig, style={'width': '40%', 'display': 'inline-block', 'height': '75vh'})
         ],
         style={'display': 'flex', 'justify-content': 'space-between'}
     )
 ])
 
-# Update the map figure
-@app.callback(
-    Output("map", "figure"),
-    Input("parameter-dropdown", "value")
-)
-def update_map(selected_parameter):
-    # Prepare data for the map
-    map_df = pd.DataFrame(site_data)
-
-    # Create the map figure
-    map_fig = px.scatter_mapbox(
-        map_df,
-        lat="Latitude",
-        lon="Longitude",
-        hover_name="Sample Site",
-        title="Sample Site Locations",
-        zoom=12  # Set zoom level closer
-    )
-    map_fig.update_traces(marker=dict(size=10, color="blue", opacity=0.8))
-
-    # Mapbox settings
-    map_fig.update_layout(
-        mapbox_style="satellite",
-        mapbox_accesstoken=mapbox_token,
-        margin={"r": 0, "t": 0, "l": 0, "b": 0}
-    )
-
-    return map_fig
-
-# Update the profile plot when a site is clicked on the map or when the app loads
-@app.callback(
+# Update the profile plot in the browser when a site is clicked on the map or when the app loads
+# (see assets/profile.js)
+app.clientside_callback(
+    ClientsideFunction(namespace="profile", function_name="render"),
     Output("profile-plot", "figure"),
-    [Input("map", "clickData"), Input("parameter-dropdown", "value")]
+    [Input("map", "clickData"), Input("parameter-dropdown", "value")],
+    State("all-profiles", "data")
 )
-def update_profile_plot(clickData, selected_parameter):
-    # If no site is selected (on initial load), default to "Sample Site 1"
-    if clickData is None:
-        df_default = pd.read_csv(default_site["FilePath"])
-        return generate_profile_plot(df_default, selected_parameter)
-
-    # Get the coordinates of the clicked point
-    lat = clickData["points"][0]["lat"]
-    lon = clickData["points"][0]["lon"]
-
-    # Find the file corresponding to the clicked site
-    selected_site = next((site for site in site_data if site["Latitude"] == lat and site["Longitude"] == lon), None)
-    if selected_site is None:
-        print(f"No data found for Latitude: {lat}, Longitude: {lon}")
-        return go.Figure()
-
-    # Load the site's data and create the profile plot
-    df = pd.read_csv(selected_site["FilePath"])
-    profile_plot = generate_profile_plot(df, selected_parameter)
-
-    return profile_plot
 
 # Run the app
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+// Clientside callbacks for the Water Quality Map (loaded automatically by Dash from the assets folder)
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    profile: {
+        // Build the profile plot for the clicked site (or the default site on load) from the stored depth profiles
+        render: function (clickData, parameter, allProfiles) {
+            // Keep the current plot while the parameter dropdown is cleared
+            if (!parameter) {
+                return window.dash_clientside.no_update;
+            }
+
+            // Get the label of the clicked site (customdata, falling back to the hover text)
+            let label = allProfiles.default;
+            if (clickData) {
+                const point = clickData.points[0];
+                label = point.customdata !== undefined ? point.customdata : point.hovertext;
+            }
+
+            // Find the profile corresponding to the clicked label
+            const profile = allProfiles.profiles[label];
+            if (!profile) {
+                console.log("No data found for site: " + label);
+                return window.dash_clientside.no_update;
+            }
+
+            // Use the averaged values of the selected parameter at each depth, if the site has them
+            const hasParameter = parameter in profile && "DEP m" in profile;
+            const trace = {
+                type: "scatter",
+                mode: "markers",
+                x: hasParameter ? profile[parameter] : [],
+                y: hasParameter ? profile["DEP m"] : [],
+                hovertemplate: parameter + "=%{x}<br>Depth (m)=%{y}<extra></extra>"
+            };
+
+            // Build the layout fresh (not from the live figure, which Plotly updates with zoom and pan ranges)
+            const layout = {
+                template: allProfiles.template,
+                title: {text: parameter + " Profile"},
+                xaxis: {title: {text: parameter}, autorange: true},
+                yaxis: {title: {text: "Depth (m)"}, autorange: "reversed"}  // Invert y-axis for depth
+            };
+
+            return {data: [trace], layout: layout};
+        }
+    }
+});